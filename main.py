@@ -1,12 +1,23 @@
 import os
-import json
+import re
 import logging
 import io
-from telebot import TeleBot
-from flask import Flask, request, jsonify
+import time
+import asyncio
+import weakref
+import functools
+import hashlib
+import contextlib
+from collections import deque
+import orjson
+from cachetools import LRUCache, TTLCache
+from telebot.async_telebot import AsyncTeleBot
+from telebot import types, util, asyncio_helper
+from quart import Quart, request, jsonify
 from google import genai
 from google.genai.errors import APIError
-from PIL import Image
+from google.genai.types import Part
+from PIL import Image, features
 
 # --- تنظیمات اولیه و متغیرهای محیطی ---
 # تلاش برای دریافت متغیرهای حیاتی از محیط Railway
@@ -26,113 +37,456 @@ logger = logging.getLogger(__name__)
 # --- راه‌اندازی ربات و مدل Gemini ---
 if not BOT_TOKEN or not GEMINI_API_KEY or not WEBHOOK_BASE:
     logger.error("!!! متغیرهای محیطی حیاتی (BOT_TOKEN, GEMINI_API_KEY, WEBHOOK_BASE) تنظیم نشده‌اند. !!!")
-    # در محیط Gunicorn، این خروج باعث توقف پروسه می‌شود
+    # در محیط Uvicorn، این خروج باعث توقف پروسه می‌شود
     # اما در Railway معمولاً این متغیرها تنظیم شده‌اند.
     # برای جلوگیری از خطای ناگهانی در زمان Import، ادامه می‌دهیم اما با لاگ خطا.
     pass
 
 # راه‌اندازی ربات تلگرام
-# threaded=False برای محیط Webhook ضروری است
-bot = TeleBot(BOT_TOKEN, threaded=False)
+# نسخه async تا درخواست‌های هم‌زمان کاربران روی یک event loop اجرا شوند
+bot = AsyncTeleBot(BOT_TOKEN)
+
+# رمزگشایی JPEG داغ‌ترین بخش پردازش عکس است؛ libjpeg معمولی حدود دو برابر کندتر است
+if not features.check_feature("libjpeg_turbo"):
+    logger.warning("!!! Pillow is not built with libjpeg-turbo; photo decoding will be slow. !!!")
 
 # راه‌اندازی سرویس Gemini
-gemini_client = None
-if GEMINI_API_KEY:
+# کلاینت در اولین استفاده ساخته می‌شود تا شروع سرد و بررسی سلامت (/) سریع بمانند
+@functools.lru_cache(maxsize=1)
+def get_gemini_client():
+    """کلاینت Gemini این پروسه را برمی‌گرداند (یا None اگر کلید API تنظیم نشده باشد)."""
+    if not GEMINI_API_KEY:
+        return None
     try:
-        gemini_client = genai.Client(api_key=GEMINI_API_KEY)
+        client = genai.Client(api_key=GEMINI_API_KEY)
         logger.info("Gemini client initialized successfully.")
+        return client
     except Exception as e:
-        logger.error(f"Failed to initialize Gemini client: {e}")
+        logger.error("Failed to initialize Gemini client: %s", e)
+        return None
+
+# --- کنترل نرخ درخواست‌های Gemini ---
+# سقف‌های پیش‌فرض Google AI برای هر کلید (درخواست هم‌زمان، درخواست و توکن در دقیقه)
+GEMINI_MAX_CONCURRENCY = 8
+GEMINI_RPM = 60
+GEMINI_TPM = 100_000
+# هر عکس تقریباً معادل 258 توکن ورودی حساب می‌شود
+IMAGE_TOKEN_ESTIMATE = 258
+GEMINI_MAX_RETRIES = 3
+GEMINI_MAX_BACKOFF = 30
+
+class RateLimiter:
+    """محدودکننده پنجره لغزان یک‌دقیقه‌ای برای تعداد درخواست و توکن."""
+
+    def __init__(self, rpm, tpm, window=60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.window = window
+        self._events = deque()  # زوج‌های (زمان، تعداد توکن)
+        self._tokens = 0
+
+    def _prune(self, now):
+        while self._events and now - self._events[0][0] >= self.window:
+            _, tokens = self._events.popleft()
+            self._tokens -= tokens
+
+    async def acquire(self, tokens):
+        """تا زمانی که درخواست جدید در سقف RPM/TPM جا شود صبر می‌کند."""
+        # درخواستی که به‌تنهایی از TPM بزرگ‌تر است هرگز جا نمی‌شود؛ آن را به سقف محدود می‌کنیم
+        tokens = min(tokens, self.tpm)
+        while True:
+            now = time.monotonic()
+            self._prune(now)
+            if len(self._events) < self.rpm and self._tokens + tokens <= self.tpm:
+                self._events.append((now, tokens))
+                self._tokens += tokens
+                return
+            await asyncio.sleep(self.window - (now - self._events[0][0]))
+
+GEMINI_SEM = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+gemini_limiter = RateLimiter(rpm=GEMINI_RPM, tpm=GEMINI_TPM)
+
+def estimate_tokens(contents):
+    """تخمین سرانگشتی توکن‌های ورودی: هر ۴ کاراکتر یک توکن به‌علاوه سهم عکس‌ها."""
+    parts = contents if isinstance(contents, list) else [contents]
+    tokens = 0
+    for part in parts:
+        if isinstance(part, str):
+            tokens += len(part) // 4
+        else:
+            tokens += IMAGE_TOKEN_ESTIMATE
+    return max(tokens, 1)
+
+async def stream_gemini(contents):
+    """دریافت پاسخ Gemini به‌صورت جریانی با محدودیت هم‌زمانی، کنترل نرخ و تلاش مجدد برای خطای 429."""
+    tokens = estimate_tokens(contents)
+    delay = 1
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        started = False
+        try:
+            # جای هم‌زمانی تا پایان جریان (حتی هنگام yield و ویرایش پیام در تلگرام) نگه داشته
+            # می‌شود؛ این عمدی است، چون درخواست Gemini در تمام این مدت باز است و باید در
+            # سقف GEMINI_MAX_CONCURRENCY شمرده شود
+            async with GEMINI_SEM:
+                # سهمیه RPM/TPM درست پیش از ارسال ثبت می‌شود تا زمان ثبت‌شده با زمان واقعی
+                # ارسال یکی باشد و انتظار در صف semaphore پنجره یک‌دقیقه‌ای را جابه‌جا نکند
+                await gemini_limiter.acquire(tokens)
+                # درخواست HTTP هنگام دریافت اولین تکه ارسال می‌شود
+                stream = await get_gemini_client().aio.models.generate_content_stream(
+                    model='gemini-2.5-flash',
+                    contents=contents
+                )
+                async for chunk in stream:
+                    started = True
+                    yield chunk
+            return
+        except APIError as e:
+            # پس از ارسال اولین تکه به کاربر، تکرار درخواست ممکن نیست
+            if started or e.code != 429 or attempt == GEMINI_MAX_RETRIES:
+                raise
+            delay = min(delay * 2, GEMINI_MAX_BACKOFF)
+            logger.warning("Gemini rate limited (429), retrying in %ss...", delay)
+            # انتظار بیرون از semaphore انجام می‌شود تا جای درخواست‌های دیگر اشغال نشود
+            await asyncio.sleep(delay)
+
+# پیام در حال نوشتن پس از اضافه شدن حداقل این تعداد کاراکتر ویرایش می‌شود
+STREAM_EDIT_CHARS = 200
+# و حداکثر یک بار در هر ثانیه، تا به محدودیت نرخ ویرایش تلگرام برخورد نکنیم
+STREAM_EDIT_INTERVAL = 1.0
+# سقف طول هر پیام تلگرام؛ پاسخ‌های بلندتر در چند پیام پشت سر هم ادامه می‌یابند
+TELEGRAM_MAX_MESSAGE = util.MAX_MESSAGE_LENGTH
+
+class StreamingReply:
+    """نمایش پاسخ جریانی در یک یا چند پیام تلگرام که هر کدام حداکثر TELEGRAM_MAX_MESSAGE کاراکتر دارند."""
+
+    def __init__(self, message):
+        self.message = message
+        self.text = ""
+        self.started = False     # آیا تا کنون پیامی ارسال شده است
+        self._offset = 0         # ابتدای پیام فعلی در self.text
+        self._sent = None        # پیام تلگرامی که در حال ویرایش است
+        self._sent_text = ""     # آخرین متنی که در پیام فعلی نمایش داده شده
+        self._sent_at = 0.0
+
+    async def append(self, chunk_text):
+        """اضافه کردن یک تکه و به‌روزرسانی پیام‌ها (با رعایت محدودیت نرخ ویرایش)."""
+        self.text += chunk_text
+        await self._flush(final=False)
+
+    async def finish(self):
+        """نمایش باقی‌مانده متن پس از پایان جریان."""
+        await self._flush(final=True)
+
+    async def _flush(self, final):
+        # پیام‌هایی که از سقف طول گذشته‌اند با smart_split بسته می‌شوند و ادامه متن به پیام بعدی می‌رود
+        while len(self.text) - self._offset > TELEGRAM_MAX_MESSAGE:
+            head = util.smart_split(self.text[self._offset:], TELEGRAM_MAX_MESSAGE)[0]
+            self._offset += len(head)
+            if head.strip():
+                await self._show(head.strip())
+                self._sent = None
+                self._sent_text = ""
+
+        display = self.text[self._offset:].strip()
+        if (final or self._sent is None
+                or (len(display) - len(self._sent_text) >= STREAM_EDIT_CHARS
+                    and time.monotonic() - self._sent_at >= STREAM_EDIT_INTERVAL)):
+            await self._show(display)
+
+    async def _show(self, display):
+        # تلگرام فاصله‌های ابتدا و انتهای متن را حذف می‌کند؛ متن خالی یا بدون تغییر ارسال نمی‌شود
+        if not display or display == self._sent_text:
+            return
+        if self._sent is not None:
+            await bot.edit_message_text(display, chat_id=self.message.chat.id, message_id=self._sent.message_id)
+        elif self.started:
+            self._sent = await bot.send_message(self.message.chat.id, display)
+        else:
+            self._sent = await bot.reply_to(self.message, display)
+            self.started = True
+        self._sent_text = display
+        self._sent_at = time.monotonic()
+
+# --- پردازش عکس ---
+# Gemini عکس‌ها را حدوداً تا 768 پیکسل کوچک می‌کند؛ دانلود نسخه بزرگ‌تر بی‌فایده است
+PHOTO_MIN_SIDE = 768
+# عکس پیش از ارسال به Gemini حداکثر تا این اندازه کوچک می‌شود
+PHOTO_MAX_SIDE = 1024
+PHOTO_JPEG_QUALITY = 85
+# بایت‌های عکس‌های دانلودشده بر اساس file_unique_id نگه‌داری می‌شوند تا ارسال دوباره
+# همان عکس به get_file و download_file نیاز نداشته باشد؛ سقف بر حسب حجم کل است
+DOWNLOAD_CACHE_BYTES = 128 * 1024 * 1024
+download_cache = LRUCache(maxsize=DOWNLOAD_CACHE_BYTES, getsizeof=len)
+
+async def download_photo(photo):
+    """دانلود یک PhotoSize از تلگرام با استفاده از کش."""
+    data = download_cache.get(photo.file_unique_id)
+    if data is None:
+        file_info = await bot.get_file(photo.file_id)
+        data = await bot.download_file(file_info.file_path)
+        if len(data) <= DOWNLOAD_CACHE_BYTES:
+            download_cache[photo.file_unique_id] = data
+    return data
+
+# خروجی prepare_photo بر اساس هش محتوای عکس نگه‌داری می‌شود تا عکس تکراری
+# (حتی با file_unique_id متفاوت) دوباره رمزگشایی و فشرده نشود
+PREPARED_PHOTO_CACHE_BYTES = 64 * 1024 * 1024
+prepared_photo_cache = LRUCache(maxsize=PREPARED_PHOTO_CACHE_BYTES, getsizeof=len)
+
+def photo_digest(data):
+    """هش سریع BLAKE2b از محتوای عکس برای کلیدهای کش."""
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+async def get_prepared_photo(data, digest):
+    """بایت‌های JPEG آماده ارسال به Gemini را از کش یا با اجرای prepare_photo برمی‌گرداند."""
+    jpeg_bytes = prepared_photo_cache.get(digest)
+    if jpeg_bytes is None:
+        # رمزگشایی و فشرده‌سازی عکس در یک thread جدا انجام می‌شود تا event loop
+        # (و پاسخ به کاربران دیگر) پشت کار CPU متوقف نشود؛ Pillow در این مراحل GIL را آزاد می‌کند
+        jpeg_bytes = await asyncio.to_thread(prepare_photo, data)
+        prepared_photo_cache[digest] = jpeg_bytes
+    return jpeg_bytes
+
+def prepare_photo(data):
+    """عکس دانلودشده را کوچک می‌کند و به‌صورت بایت‌های JPEG برای Gemini برمی‌گرداند."""
+    # تبدیل فایل باینری به شیء Image از PIL (کاملاً در حافظه، بدون فایل موقت)
+    img = Image.open(io.BytesIO(data))
+    # draft() عکس JPEG را مستقیماً در اندازه کوچک‌تر رمزگشایی می‌کند و thumbnail()
+    # آن را به حداکثر PHOTO_MAX_SIDE می‌رساند؛ عکس خراب همین‌جا خطا می‌دهد
+    img.draft('RGB', (PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+    img.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE), Image.Resampling.LANCZOS)
+
+    # SDK عکس باز شده از حافظه را به PNG تبدیل می‌کند؛ JPEG با کیفیت ثابت
+    # حجم آپلود به Gemini را چندین برابر کاهش می‌دهد
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    jpeg_buffer = io.BytesIO()
+    img.save(jpeg_buffer, 'JPEG', quality=PHOTO_JPEG_QUALITY)
+    return jpeg_buffer.getvalue()
+
+# --- کش پاسخ‌ها ---
+# پیام‌های تکراری (مثل احوال‌پرسی یا ارسال دوباره همان عکس و توضیح) بدون فراخوانی Gemini پاسخ داده می‌شوند
+RESPONSE_CACHE_SIZE = 2000
+RESPONSE_CACHE_TTL = 600
+response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+def make_cache_key(prompt, image_digest=None):
+    """کلید کش از متن نرمال‌شده و (در صورت وجود) هش محتوای عکس ساخته می‌شود."""
+    digest = hashlib.sha1()
+    if image_digest:
+        digest.update(image_digest)
+    digest.update(" ".join(prompt.split()).casefold().encode('utf-8'))
+    return digest.hexdigest()
+
+# --- پاسخ‌های محلی برای ورودی‌های ساده ---
+# احوال‌پرسی، تشکر و پیام‌های خیلی کوتاه بدون فراخوانی Gemini پاسخ داده می‌شوند
+MIN_PROMPT_LENGTH = 3
+SHORT_PROMPT_REPLY = "لطفاً سوال یا درخواست خود را کمی کامل‌تر بنویسید. 🙂"
+LOCAL_REPLIES = [
+    (re.compile(r"^(سلام|درود|hi|hello|hey)[\s!.؟?]*$", re.IGNORECASE),
+     "سلام! 👋 چطور می‌توانم کمکتان کنم؟"),
+    (re.compile(r"^(ممنون|مرسی|متشکرم|تشکر|thanks|thank you)[\s!.]*$", re.IGNORECASE),
+     "خواهش می‌کنم! خوشحالم که کمک کردم. 🌸"),
+    (re.compile(r"^(ok|okay|باشه|اوکی|👍)[\s!.]*$", re.IGNORECASE),
+     "👍 اگر سوال دیگری دارید، بپرسید."),
+]
+
+def get_local_reply(text):
+    """برای ورودی‌های ساده پاسخ آماده برمی‌گرداند، در غیر این صورت None."""
+    text = text.strip()
+    # الگوها پیش از شرط طول بررسی می‌شوند تا ورودی‌های کوتاهی مثل "hi" یا "ok" پاسخ خودشان را بگیرند
+    for pattern, reply in LOCAL_REPLIES:
+        if pattern.match(text):
+            return reply
+    if len(text) < MIN_PROMPT_LENGTH:
+        return SHORT_PROMPT_REPLY
+    return None
+
+# --- صف‌بندی درخواست‌های هر کاربر ---
+# dispatch_update هر آپدیت را زیر قفل چت مربوطه پردازش می‌کند تا پاسخ‌ها به ترتیب برسند
+# قفل‌ها با WeakValueDictionary نگه‌داری می‌شوند تا قفل کاربران غیرفعال خودبه‌خود آزاد شود
+user_locks = weakref.WeakValueDictionary()
+
+def get_user_lock(chat_id):
+    """قفل asyncio مخصوص یک کاربر را برمی‌گرداند (در صورت نبود، می‌سازد)."""
+    lock = user_locks.get(chat_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        user_locks[chat_id] = lock
+    return lock
+
+# --- کارهای پس‌زمینه ---
+# نگه‌داشتن ارجاع به taskها تا پیش از اتمام توسط garbage collector حذف نشوند
+background_tasks = set()
+# حداکثر زمان انتظار برای taskهای باقی‌مانده هنگام خاموش شدن سرور (ثانیه)
+SHUTDOWN_TIMEOUT = 10
+
+def _on_background_task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.warning("Background task failed: %s", task.exception())
+
+def run_in_background(coro):
+    """اجرای یک coroutine بدون انتظار برای نتیجه آن (fire-and-forget)."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
 
 # --- توابع مدیریت پیام (Handler Functions) ---
 
+# متن خوش‌آمدگویی یک بار در زمان import ساخته می‌شود
+WELCOME_TEXT = (
+    "سلام! من ربات هوش مصنوعی شما هستم. 👋\n"
+    "هر سوالی دارید بپرسید یا یک عکس به همراه توضیح برای من بفرستید.\n"
+    "من از مدل پیشرفته Gemini برای پاسخگویی استفاده می‌کنم."
+)
+
 @bot.message_handler(commands=['start', 'help'])
-def send_welcome(message):
+async def send_welcome(message):
     """پاسخ به دستورات /start و /help"""
-    welcome_text = (
-        "سلام! من ربات هوش مصنوعی شما هستم. 👋\n"
-        "هر سوالی دارید بپرسید یا یک عکس به همراه توضیح برای من بفرستید.\n"
-        "من از مدل پیشرفته Gemini برای پاسخگویی استفاده می‌کنم."
-    )
-    bot.reply_to(message, welcome_text)
-
-def generate_response(contents, chat_id, message_id):
+    await bot.reply_to(message, WELCOME_TEXT)
+
+async def generate_response(contents, message, cache_key=None):
     """تابع مرکزی برای تولید پاسخ با Gemini"""
-    if not gemini_client:
-        bot.reply_to(message_id, "متأسفانه سرویس هوش مصنوعی هنوز فعال نشده است. لطفاً متغیرهای API Key را بررسی کنید.")
+    chat_id = message.chat.id
+    if not get_gemini_client():
+        await bot.reply_to(message, "متأسفانه سرویس هوش مصنوعی هنوز فعال نشده است. لطفاً متغیرهای API Key را بررسی کنید.")
+        return
+
+    # قفل کاربر توسط dispatch_update گرفته شده است، پس پاسخ‌ها به ترتیب ارسال می‌شوند
+    cached = response_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        reply = StreamingReply(message)
+        await reply.append(cached)
+        await reply.finish()
+        logger.info("Cached response sent to %s.", chat_id)
         return
 
     try:
-        # ارسال پیام اولیه برای نشان دادن اینکه ربات در حال کار است
-        bot.send_chat_action(chat_id, 'typing')
-        
-        # تولید محتوا توسط Gemini
-        response = gemini_client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=contents
-        )
-        
-        # ارسال پاسخ به کاربر
-        bot.reply_to(message_id, response.text)
-        logger.info(f"Response sent to {chat_id}.")
-        
+        # تولید محتوا توسط Gemini به‌صورت جریانی؛ اولین تکه‌ی دارای متن به‌عنوان پاسخ ارسال
+        # و همان پیام با رسیدن تکه‌های بعدی ویرایش می‌شود
+        reply = StreamingReply(message)
+        async with contextlib.aclosing(stream_gemini(contents)) as stream:
+            async for chunk in stream:
+                if chunk.text:
+                    await reply.append(chunk.text)
+        await reply.finish()
+
+        if not reply.started:
+            raise ValueError("Gemini returned an empty response.")
+        logger.info("Response sent to %s.", chat_id)
+        if cache_key:
+            response_cache[cache_key] = reply.text
+    
     except APIError as e:
-        logger.error(f"Gemini API Error for {chat_id}: {e}")
-        bot.reply_to(message_id, "متأسفانه به دلیل خطای API هوش مصنوعی قادر به پاسخگویی نیستم. لطفاً دوباره تلاش کنید.")
+        logger.error("Gemini API Error for %s: %s", chat_id, e)
+        await bot.reply_to(message, "متأسفانه به دلیل خطای API هوش مصنوعی قادر به پاسخگویی نیستم. لطفاً دوباره تلاش کنید.")
     except Exception as e:
-        logger.error(f"General Error for {chat_id}: {e}")
-        bot.reply_to(message_id, "یک خطای ناشناخته رخ داد. تیم فنی در حال بررسی مشکل است.")
+        logger.error("General Error for %s: %s", chat_id, e)
+        await bot.reply_to(message, "یک خطای ناشناخته رخ داد. تیم فنی در حال بررسی مشکل است.")
 
 @bot.message_handler(content_types=['text'])
-def handle_text_message(message):
+async def handle_text_message(message):
     """پاسخ به تمام پیام‌های متنی"""
     user_prompt = message.text
     chat_id = message.chat.id
     
-    logger.info(f"Received text message from {chat_id}: {user_prompt[:50]}...")
-    generate_response(user_prompt, chat_id, message.message_id)
+    logger.info("Received text message from %s: %.50s...", chat_id, user_prompt)
+    # ورودی خالی پیش از هر کار دیگری رد می‌شود تا هیچ درخواستی به Gemini نرود
+    if not user_prompt or not user_prompt.strip():
+        await bot.reply_to(message, "پیامی برای پاسخ دادن دریافت نشد. لطفاً سوال خود را بنویسید.")
+        return
+
+    local_reply = get_local_reply(user_prompt)
+    if local_reply:
+        await bot.reply_to(message, local_reply)
+        return
+
+    # نمایش وضعیت "در حال نوشتن" به‌صورت موازی با درخواست Gemini
+    run_in_background(bot.send_chat_action(chat_id, 'typing'))
+    await generate_response(user_prompt, message, cache_key=make_cache_key(user_prompt))
 
 @bot.message_handler(content_types=['photo'])
-def handle_photo_message(message):
+async def handle_photo_message(message):
     """پاسخ به پیام‌های شامل عکس"""
     chat_id = message.chat.id
     # اگر توضیحی همراه عکس نباشد، یک درخواست پیش‌فرض ارسال می‌کند
     caption = message.caption or "این عکس چیست؟ لطفا آن را توصیف کن."
     
-    logger.info(f"Received photo message from {chat_id} with caption: {caption}")
+    logger.info("Received photo message from %s with caption: %s", chat_id, caption)
     
+    # وضعیت "در حال نوشتن" هم‌زمان با دانلود عکس ارسال می‌شود، نه پس از آن
+    run_in_background(bot.send_chat_action(chat_id, 'typing'))
+
     try:
-        # دریافت بزرگترین سایز عکس
-        file_info = bot.get_file(message.photo[-1].file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        
-        # تبدیل فایل باینری به شیء Image از PIL
-        image_stream = io.BytesIO(downloaded_file)
-        img = Image.open(image_stream)
+        # کوچک‌ترین سایزی که ضلع بلندش حداقل PHOTO_MIN_SIDE باشد کافی است؛
+        # Gemini عکس‌های بزرگ‌تر را خودش کوچک می‌کند (در غیر این صورت بزرگترین سایز)
+        photo = next(
+            (p for p in message.photo if max(p.width, p.height) >= PHOTO_MIN_SIDE),
+            message.photo[-1]
+        )
+        downloaded_file = await download_photo(photo)
         
+        digest = photo_digest(downloaded_file)
+        jpeg_bytes = await get_prepared_photo(downloaded_file, digest)
+
         # ساخت محتوای ترکیبی برای Gemini (عکس + متن)
-        contents = [img, caption]
+        contents = [Part.from_bytes(data=jpeg_bytes, mime_type='image/jpeg'), caption]
         
-        generate_response(contents, chat_id, message.message_id)
+        await generate_response(contents, message, cache_key=make_cache_key(caption, digest))
 
     except Exception as e:
-        logger.error(f"Error handling photo from {chat_id}: {e}")
-        bot.reply_to(message.message_id, "متأسفانه در پردازش عکس شما مشکلی پیش آمد.")
+        logger.error("Error handling photo from %s: %s", chat_id, e)
+        await bot.reply_to(message, "متأسفانه در پردازش عکس شما مشکلی پیش آمد.")
+
+# --- توزیع مستقیم آپدیت‌ها ---
+# مسیر رایج (متن و عکس) بدون پیمایش خطی handlerهای telebot به تابع مربوطه می‌رود
+MESSAGE_HANDLERS = {
+    'text': handle_text_message,
+    'photo': handle_photo_message,
+}
+# حداکثر تعداد آپدیت‌هایی که هم‌زمان پردازش می‌شوند (دانلود عکس، Gemini و پاسخ)؛
+# هر چت حداکثر یک جا را اشغال می‌کند
+MAX_CONCURRENT_UPDATES = 32
+UPDATE_SEM = asyncio.Semaphore(MAX_CONCURRENT_UPDATES)
+
+async def dispatch_update(update):
+    """ارسال آپدیت به handler مناسب؛ دستورات و سایر انواع آپدیت به telebot سپرده می‌شوند."""
+    message = update.message
+    if message is None:
+        async with UPDATE_SEM:
+            await bot.process_new_updates([update])
+        return
 
-# --- راه‌اندازی وب‌هوک Flask ---
+    # ابتدا قفل کاربر و سپس جای سراسری گرفته می‌شود؛ پیام‌های صف‌شده یک چت
+    # پشت قفل همان چت منتظر می‌مانند و جای کاربران دیگر را اشغال نمی‌کنند
+    async with get_user_lock(message.chat.id):
+        async with UPDATE_SEM:
+            handler = MESSAGE_HANDLERS.get(message.content_type)
+            if handler is None or util.is_command(message.text):
+                await bot.process_new_updates([update])
+                return
 
-# Flask App باید در سطح ماژول تعریف شود تا Gunicorn آن را پیدا کند.
-app = Flask(__name__)
+            try:
+                await handler(message)
+            except Exception as e:
+                logger.error("Unhandled error while processing update %s: %s", update.update_id, e)
+
+# --- راه‌اندازی وب‌هوک Quart ---
+
+# Quart App باید در سطح ماژول تعریف شود تا Uvicorn آن را پیدا کند.
+app = Quart(__name__)
 
 @app.route(WEBHOOK_URL_PATH, methods=['POST'])
-def webhook():
+async def webhook():
     """نقطه پایانی که تلگرام پیام‌ها را به آن ارسال می‌کند."""
     # بررسی کنید که درخواست از نوع JSON باشد
     if request.headers.get('content-type') == 'application/json':
-        json_string = request.get_data(as_text=True)
-        update = json.loads(json_string)
-        # پردازش آپدیت توسط telebot
-        bot.process_new_updates([update])
+        # orjson مستقیماً bytes را تجزیه می‌کند و نیازی به decode جداگانه نیست
+        update = types.Update.de_json(orjson.loads(await request.get_data()))
+        # پردازش آپدیت در پس‌زمینه تا پاسخ به تلگرام منتظر Gemini نماند
+        run_in_background(dispatch_update(update))
         # پاسخ 200 (OK) ضروری است تا تلگرام بداند پیام دریافت شده است
         return jsonify(status="ok"), 200
     else:
@@ -141,27 +495,35 @@ def webhook():
 
 # مسیر اصلی / که برای تست سلامت سرور استفاده می‌شود
 @app.route('/')
-def index():
+async def index():
     return "ربات تلگرام در حال اجرا است و منتظر دریافت پیام از طریق وب‌هوک است.", 200
 
 # --- تنظیم وب‌هوک در زمان استقرار ---
 
-def set_webhook_on_startup():
+# تابع set_webhook_on_startup پیش از شروع سرویس‌دهی توسط Uvicorn اجرا می‌شود
+@app.before_serving
+async def set_webhook_on_startup():
     """تنظیم وب‌هوک در تلگرام پس از شروع موفقیت‌آمیز برنامه."""
     if not WEBHOOK_BASE:
         logger.error("Cannot set webhook: WEBHOOK_BASE is not defined.")
         return
         
     try:
-        # حذف وب‌هوک‌های قدیمی (در صورت وجود)
-        bot.remove_webhook()
-        # تنظیم وب‌هوک جدید
-        if bot.set_webhook(url=WEBHOOK_URL):
-            logger.info(f"Webhook set successfully to: {WEBHOOK_URL}")
+        # setWebhook آدرس قبلی را به‌صورت اتمی جایگزین می‌کند و نیازی به remove_webhook نیست
+        if await bot.set_webhook(url=WEBHOOK_URL):
+            logger.info("Webhook set successfully to: %s", WEBHOOK_URL)
         else:
             logger.error("!!! Webhook setting failed. Check your BOT_TOKEN and WEBHOOK_BASE. !!!")
     except Exception as e:
-        logger.error(f"Failed to set webhook: {e}. Check network connectivity or environment variables.")
+        logger.error("Failed to set webhook: %s. Check network connectivity or environment variables.", e)
 
-# تابع set_webhook_on_startup در زمان import شدن ماژول توسط Gunicorn اجرا می‌شود
-set_webhook_on_startup()
+@app.after_serving
+async def close_bot_session():
+    """بستن نشست HTTP ربات هنگام خاموش شدن سرور."""
+    # فرصت کوتاهی برای تمام شدن پاسخ‌های در حال ارسال
+    if background_tasks:
+        await asyncio.wait(set(background_tasks), timeout=SHUTDOWN_TIMEOUT)
+    # نشست aiohttp تا اولین درخواست به تلگرام ساخته نمی‌شود
+    if asyncio_helper.session_manager.session is None:
+        return
+    await bot.close_session()